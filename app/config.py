@@ -5,6 +5,15 @@ import os
 LOG_LEVEL = "INFO"
 TIMEZONE = pytz.timezone("Asia/Tokyo")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./markov_data.db")
+DB_POOL_SIZE = 10
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -64 * 1024
+BOT_NAMES = ["marky", "марки"]
+
+# Telegram
+CONCURRENT_UPDATES = 8
+CONNECTION_POOL_SIZE = 16
+POOL_TIMEOUT = 5
 
 # Markov Chain
 MARKOV_ORDER = 2
@@ -12,5 +21,17 @@ RANDOM_REPLY_CHANCE = 0.01
 WORD_FROM_USER_CHANCE = 0.6
 MAX_FILE_SIZE_KB = 1024
 MAX_JSON_FILE_SIZE_MB = 10
+JSON_STREAM_THRESHOLD_MB = 2
 MAX_FILE_CHUNK_SIZE = 500
 MAX_FILE_CHUNKS = 10
+MAX_INSERT_BATCH_SIZE = 500
+FEED_BATCH_SIZE = 5000
+WRITE_BEHIND_INTERVAL = 1.0
+WRITE_BEHIND_MAX_ROWS = 500
+
+# Caching
+SETTINGS_CACHE_TTL = 60
+SETTINGS_CACHE_SIZE = 10000
+MODEL_CACHE_SIZE = 128
+ADMIN_CACHE_TTL = 60
+ADMIN_CACHE_SIZE = 1000
@@ -1,4 +1,7 @@
 import logging
+import threading
+import time
+from typing import NamedTuple
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 from models import GroupSettings, MarkovData
@@ -7,6 +10,17 @@ import config as config
 logger = logging.getLogger(__name__)
 
 
+class ChatSettings(NamedTuple):
+    markov_order: int
+    random_reply_chance: float
+    word_from_user_chance: float
+
+
+_SETTINGS_CACHE: dict[int, tuple[ChatSettings, float]] = {}
+_SETTINGS_CACHE_LOCK = threading.Lock()
+_SETTINGS_VERSION: dict[int, int] = {}
+
+
 def get_group_settings(db: Session, chat_id: int) -> GroupSettings:
     return db.query(GroupSettings).filter(GroupSettings.chat_id == chat_id).first()
 
@@ -21,26 +35,50 @@ def update_group_settings(db: Session, chat_id: int, settings: dict) -> GroupSet
         setattr(group_settings, key, value)
 
     db.commit()
-    db.refresh(group_settings)
+    with _SETTINGS_CACHE_LOCK:
+        _SETTINGS_VERSION[chat_id] = _SETTINGS_VERSION.get(chat_id, 0) + 1
+        _SETTINGS_CACHE.pop(chat_id, None)
     return group_settings
 
 
-def get_markov_order(db: Session, chat_id: int) -> int:
+def _setting_or_default(settings: GroupSettings | None, name: str, default):
+    value = getattr(settings, name, None)
+    return default if value is None else value
+
+
+def get_chat_settings(db: Session, chat_id: int) -> ChatSettings:
+    now = time.monotonic()
+    with _SETTINGS_CACHE_LOCK:
+        cached = _SETTINGS_CACHE.get(chat_id)
+        if cached and now - cached[1] < config.SETTINGS_CACHE_TTL:
+            return cached[0]
+        version = _SETTINGS_VERSION.get(chat_id, 0)
+
     settings = get_group_settings(db, chat_id)
-    if settings and settings.markov_order is not None:
-        return settings.markov_order
-    return config.MARKOV_ORDER
+    chat_settings = ChatSettings(
+        markov_order=_setting_or_default(
+            settings, "markov_order", config.MARKOV_ORDER),
+        random_reply_chance=_setting_or_default(
+            settings, "random_reply_chance", config.RANDOM_REPLY_CHANCE),
+        word_from_user_chance=_setting_or_default(
+            settings, "word_from_user_chance", config.WORD_FROM_USER_CHANCE)
+    )
+    with _SETTINGS_CACHE_LOCK:
+        if _SETTINGS_VERSION.get(chat_id, 0) == version:
+            _SETTINGS_CACHE.pop(chat_id, None)
+            _SETTINGS_CACHE[chat_id] = (chat_settings, now)
+            if len(_SETTINGS_CACHE) > config.SETTINGS_CACHE_SIZE:
+                _SETTINGS_CACHE.pop(next(iter(_SETTINGS_CACHE)), None)
+    return chat_settings
+
+
+def get_markov_order(db: Session, chat_id: int) -> int:
+    return get_chat_settings(db, chat_id).markov_order
 
 
 def get_random_reply_chance(db: Session, chat_id: int) -> float:
-    settings = get_group_settings(db, chat_id)
-    if settings and settings.random_reply_chance is not None:
-        return settings.random_reply_chance
-    return config.RANDOM_REPLY_CHANCE
+    return get_chat_settings(db, chat_id).random_reply_chance
 
 
 def get_word_from_user_chance(db: Session, chat_id: int) -> float:
-    settings = get_group_settings(db, chat_id)
-    if settings and settings.word_from_user_chance is not None:
-        return settings.word_from_user_chance
-    return config.WORD_FROM_USER_CHANCE
+    return get_chat_settings(db, chat_id).word_from_user_chance
@@ -1,14 +1,73 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, make_url
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import sessionmaker
 from models import Base
 import config as config
 
-engine = create_engine(config.DATABASE_URL)
+_UNUSED_INDEXES = (("markov_data", "ix_markov_data_chat_word2"),)
+
+
+def _engine_options(url: str) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+    return {"pool_pre_ping": True, "pool_size": config.DB_POOL_SIZE}
+
+
+engine = create_engine(
+    config.DATABASE_URL,
+    insertmanyvalues_page_size=config.MAX_INSERT_BATCH_SIZE,
+    **_engine_options(config.DATABASE_URL)
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size={int(config.SQLITE_CACHE_SIZE)}")
+    finally:
+        cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def _add_missing_columns():
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}")
+
+
+def _drop_unused_indexes():
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table_name, index_name in _UNUSED_INDEXES:
+            existing = {index["name"] for index in inspector.get_indexes(table_name)}
+            if index_name not in existing:
+                continue
+            on_table = f" ON {preparer.quote(table_name)}" if engine.dialect.name == "mysql" else ""
+            connection.exec_driver_sql(f"DROP INDEX {preparer.quote(index_name)}{on_table}")
+
+
 def setup_database():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+    _drop_unused_indexes()
 
 
 def get_db():
@@ -1,8 +1,17 @@
 import random
 import logging
-from collections import defaultdict
+import string
+import sys
+import threading
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate, chain, islice
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Iterator
 from sqlalchemy.orm import Session
-from sqlalchemy import select, func, or_
+from sqlalchemy import select, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from models import MarkovData
@@ -11,158 +20,327 @@ import crud as crud
 
 logger = logging.getLogger(__name__)
 
+_START = sys.intern("<START>")
+_END = sys.intern("<END>")
+_PUNCT = string.punctuation + "".join(
+    chr(code) for code in range(0x80, sys.maxunicode + 1)
+    if unicodedata.category(chr(code)).startswith("P")
+)
+_MODEL_CACHE: OrderedDict[int, tuple[int, int, dict, tuple]] = OrderedDict()
+_MODEL_CACHE_LOCK = threading.Lock()
+_MODEL_VERSION: dict[int, int] = {}
+_MODEL_WRITERS: dict[int, int] = {}
+_PENDING_SAVES: dict[int, Counter] = {}
+_PENDING_SAVES_LOCK = threading.Lock()
+_FLUSH_LOCKS: dict[int, threading.Lock] = {}
+
+
+def tokenize(text: str) -> list[str]:
+    return [word for word in (token.strip(_PUNCT) for token in text.lower().split()) if word]
+
+
+def word_triples(words: list[str]) -> Iterator[tuple[str, str, str]]:
+    return zip(chain((_START,), words), words,
+               chain(islice(words, 1, None), (_END,)))
+
+
+def _begin_chat_update(chat_id: int) -> int:
+    with _MODEL_CACHE_LOCK:
+        version = _MODEL_VERSION.get(chat_id, 0)
+        _MODEL_VERSION[chat_id] = version + 1
+        _MODEL_WRITERS[chat_id] = _MODEL_WRITERS.get(chat_id, 0) + 1
+        return version
+
+
+def _finish_chat_update(chat_id: int, version: int, pair_counts: Counter | None):
+    with _MODEL_CACHE_LOCK:
+        cached = _MODEL_CACHE.get(chat_id)
+    merged = None
+    if pair_counts and cached and cached[0] == version:
+        merged = _apply_to_cached_model(cached, pair_counts)
+
+    with _MODEL_CACHE_LOCK:
+        writers = _MODEL_WRITERS.pop(chat_id, 1) - 1
+        if writers:
+            _MODEL_WRITERS[chat_id] = writers
+        if merged and _MODEL_CACHE.get(chat_id) is cached:
+            states, starting_states = merged
+            cached[2].update(states)
+            _MODEL_CACHE[chat_id] = (version + 1, cached[1],
+                                     cached[2], starting_states)
+
+
+@lru_cache(maxsize=None)
+def _upsert_statement(dialect: str):
+    if dialect == "mysql":
+        stmt = mysql_insert(MarkovData)
+        return stmt.on_duplicate_key_update(
+            count=MarkovData.count + stmt.inserted["count"],
+            updated_at=func.now()
+        )
+
+    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+    stmt = insert(MarkovData)
+    return stmt.on_conflict_do_update(
+        index_elements=["chat_id", "word1", "word2", "next_word"],
+        set_=dict(
+            count=MarkovData.count + stmt.excluded["count"],
+            updated_at=func.now()
+        )
+    )
 
-def save_to_database(db: Session, chat_id: int, word_pairs: list):
-    if not word_pairs:
+
+def save_to_database(db: Session, chat_id: int, word_pairs: Iterable[tuple[str, str, str]] | Counter):
+    pair_counts = word_pairs if isinstance(
+        word_pairs, Counter) else Counter(word_pairs)
+    if not pair_counts:
         return
 
+    version = _begin_chat_update(chat_id)
+    saved = False
     try:
         dialect = db.bind.dialect.name
         values = [
-            {"chat_id": chat_id, "word1": w1, "word2": w2, "next_word": nw}
-            for w1, w2, nw in word_pairs
+            {"chat_id": chat_id, "word1": w1, "word2": w2,
+             "next_word": nw, "count": count}
+            for (w1, w2, nw), count in pair_counts.items()
         ]
 
-        if dialect == "postgresql":
-            stmt = pg_insert(MarkovData).values(values)
-        elif dialect == "sqlite":
-            stmt = sqlite_insert(MarkovData).values(values)
-        else:
+        if dialect not in ("postgresql", "sqlite", "mysql"):
             # Fallback for other dialects
             for pair in values:
-                db.merge(MarkovData(**pair))
-            db.commit()
-            return
-
-        # For both postgresql and sqlite, we can use on_conflict_do_update
-        update_stmt = stmt.on_conflict_do_update(
-            index_elements=["chat_id", "word1", "word2", "next_word"],
-            set_=dict(updated_at=func.now())
-        )
-        db.execute(update_stmt)
+                key = (chat_id, pair["word1"],
+                       pair["word2"], pair["next_word"])
+                existing = db.get(MarkovData, key)
+                if existing:
+                    existing.count += pair["count"]
+                else:
+                    db.add(MarkovData(**pair))
+        else:
+            db.execute(_upsert_statement(dialect), values)
         db.commit()
+        saved = True
     except Exception as e:
         logger.error(f"Database error during save: {e}")
         db.rollback()
+    finally:
+        _finish_chat_update(chat_id, version, pair_counts if saved else None)
 
 
-def word_exists_in_db(db: Session, chat_id: int, word: str) -> bool:
-    try:
-        stmt = select(func.count()).select_from(MarkovData).where(
-            MarkovData.chat_id == chat_id,
-            or_(MarkovData.word1 == word, MarkovData.word2 == word)
-        )
-        count = db.execute(stmt).scalar_one()
-        return count > 0
-    except Exception as e:
-        logger.error(f"Error checking word existence: {e}")
-        return False
+def queue_for_save(chat_id: int, word_pairs: Iterable[tuple[str, str, str]]) -> int:
+    with _PENDING_SAVES_LOCK:
+        _PENDING_SAVES.setdefault(chat_id, Counter()).update(word_pairs)
+        return sum(map(len, _PENDING_SAVES.values()))
 
 
-def get_random_word_from_db(db: Session, chat_id: int) -> str | None:
-    try:
-        stmt = select(MarkovData.word1).where(
-            MarkovData.chat_id == chat_id,
-            MarkovData.word1.notin_(["<START>", "<END>"])
-        ).order_by(func.random()).limit(1)
+def _flush_chat(db: Session, chat_id: int):
+    with _PENDING_SAVES_LOCK:
+        flush_lock = _FLUSH_LOCKS.setdefault(chat_id, threading.Lock())
 
-        result = db.execute(stmt).scalar_one_or_none()
-        return result
-    except Exception as e:
-        logger.error(f"Error getting random word: {e}")
-        return None
+    with flush_lock:
+        with _PENDING_SAVES_LOCK:
+            pair_counts = _PENDING_SAVES.pop(chat_id, None)
+        if pair_counts:
+            save_to_database(db, chat_id, pair_counts)
 
 
-def build_markov_model(db: Session, chat_id: int):
-    stmt = select(MarkovData.word1, MarkovData.word2,
-                  MarkovData.next_word).where(MarkovData.chat_id == chat_id)
-    data = db.execute(stmt).fetchall()
+def flush_pending_saves(db: Session, chat_id: int | None = None):
+    if chat_id is not None:
+        _flush_chat(db, chat_id)
+        return
 
-    if not data:
-        return None, None
+    with _PENDING_SAVES_LOCK:
+        chat_ids = list(_PENDING_SAVES)
+    for pending_chat_id in chat_ids:
+        _flush_chat(db, pending_chat_id)
 
-    transitions = defaultdict(lambda: defaultdict(int))
-    starting_states = []
-    markov_order = crud.get_markov_order(db, chat_id)
 
-    for word1, word2, next_word in data:
+def _weighted_table(counts: dict) -> tuple[tuple, tuple[int, ...]]:
+    if _END in counts:
+        counts = {_END: counts[_END], **counts}
+    return tuple(counts), tuple(accumulate(counts.values()))
+
+
+def _weighted_choice(items: tuple, cum_weights: tuple[int, ...]):
+    return items[bisect_right(cum_weights, random.random() * cum_weights[-1])]
+
+
+def _merge_weighted_table(table: tuple | None, deltas: dict) -> tuple[tuple, tuple[int, ...]]:
+    counts = {}
+    if table:
+        words, cum_weights = table
+        counts = dict(zip(words, map(
+            int.__sub__, cum_weights, (0,) + cum_weights[:-1])))
+    for word, count in deltas.items():
+        counts[word] = counts.get(word, 0) + count
+    return _weighted_table(counts)
+
+
+def _get_cached_model(chat_id: int, markov_order: int) -> tuple[tuple[dict, tuple] | None, int | None]:
+    with _MODEL_CACHE_LOCK:
+        version = _MODEL_VERSION.get(chat_id, 0)
+        cached = _MODEL_CACHE.get(chat_id)
+        if cached and cached[0] == version and cached[1] == markov_order:
+            _MODEL_CACHE.move_to_end(chat_id)
+            return (cached[2], cached[3]), version
+        return None, None if _MODEL_WRITERS.get(chat_id) else version
+
+
+def _store_cached_model(chat_id: int, version: int, markov_order: int, transitions: dict, starting_states: tuple):
+    with _MODEL_CACHE_LOCK:
+        if _MODEL_VERSION.get(chat_id, 0) != version:
+            return
+        _MODEL_CACHE[chat_id] = (version, markov_order,
+                                 transitions, starting_states)
+        _MODEL_CACHE.move_to_end(chat_id)
+        while len(_MODEL_CACHE) > config.MODEL_CACHE_SIZE:
+            _MODEL_CACHE.popitem(last=False)
+
+
+def _apply_to_cached_model(cached: tuple, pair_counts: Counter) -> tuple[dict, tuple]:
+    _, markov_order, transitions, starting_states = cached
+    intern = sys.intern
+
+    deltas = {}
+    start_deltas = {}
+    for (word1, word2, next_word), count in pair_counts.items():
+        word1 = intern(word1)
+        word2 = intern(word2)
         if markov_order == 1:
-            if word1 == "<START>":
-                starting_states.append(word2)
-            transitions[word1][word2] += 1
+            if word1 is _START:
+                start_deltas[word2] = start_deltas.get(word2, 0) + count
+            next_words = deltas.setdefault(word1, {})
+            next_words[word2] = next_words.get(word2, 0) + count
         else:
-            if word1 == "<START>":
-                starting_states.append((word1, word2))
-            transitions[(word1, word2)][next_word] += 1
+            state = (word1, word2)
+            if word1 is _START:
+                start_deltas[state] = start_deltas.get(state, 0) + count
+            deltas.setdefault(state, {})[intern(next_word)] = count
+
+    states = {
+        state: _merge_weighted_table(transitions.get(state), next_words)
+        for state, next_words in deltas.items()
+    }
+    if start_deltas:
+        starting_states = _merge_weighted_table(starting_states, start_deltas)
+
+    return states, starting_states
+
+
+def build_markov_model(db: Session, chat_id: int):
+    markov_order = crud.get_markov_order(db, chat_id)
+    cached, version = _get_cached_model(chat_id, markov_order)
+    if cached:
+        return cached
+
+    stmt = select(MarkovData.word1, MarkovData.word2, MarkovData.next_word,
+                  MarkovData.count).where(MarkovData.chat_id == chat_id)
+    data = db.execute(stmt).fetchall()
+
+    counts = {}
+    start_counts = {}
+
+    intern = sys.intern
+
+    if markov_order == 1:
+        for word1, word2, next_word, count in data:
+            word1 = intern(word1)
+            word2 = intern(word2)
+            if word1 is _START:
+                start_counts[word2] = start_counts.get(word2, 0) + count
+            next_words = counts.setdefault(word1, {})
+            next_words[word2] = next_words.get(word2, 0) + count
+    else:
+        for word1, word2, next_word, count in data:
+            word1 = intern(word1)
+            state = (word1, intern(word2))
+            if word1 is _START:
+                start_counts[state] = start_counts.get(state, 0) + count
+            counts.setdefault(state, {})[intern(next_word)] = count
+
+    transitions = {
+        state: _weighted_table(next_words)
+        for state, next_words in counts.items()
+    }
+    starting_states = _weighted_table(start_counts)
+
+    if version is not None:
+        _store_cached_model(chat_id, version, markov_order,
+                            transitions, starting_states)
 
     return transitions, starting_states
 
 
+def filter_startable_words(db: Session, chat_id: int, words: list[str]) -> set[str]:
+    transitions, _ = build_markov_model(db, chat_id)
+    if not transitions:
+        return set()
+
+    if crud.get_markov_order(db, chat_id) == 1:
+        return {word for word in words if word in transitions}
+    return {word for word in words if (_START, word) in transitions}
+
+
 def generate_message(db: Session, chat_id: int, max_length=30, starting_word: str | None = None) -> str:
     transitions, starting_states = build_markov_model(db, chat_id)
 
-    if not starting_states:
+    if not starting_states or not starting_states[0]:
         return "Hmph. I don't have enough data to say anything. Don't expect me to talk if you don't talk first, baka!"
 
-    message = []
-    current_state = None
     soft_length_limit = max_length * 0.5
     markov_order = crud.get_markov_order(db, chat_id)
 
     if markov_order == 1:
-        if starting_word and starting_word in transitions:
-            current_state = starting_word
-        else:
-            current_state = random.choice(
-                starting_states) if starting_states else None
-        if current_state:
-            message = [current_state]
+        current_state = starting_word
     else:
-        if starting_word:
-            valid_states = [
-                s for s in starting_states if s[1] == starting_word]
-            if valid_states:
-                current_state = random.choice(valid_states)
-                message = [current_state[1]]
-        if not current_state:
-            current_state = random.choice(starting_states)
-            message = [current_state[1]]
-
-    while current_state and len(message) < max_length * 1.5:
-        if current_state not in transitions:
-            break
+        current_state = (_START, starting_word)
+    if not starting_word or current_state not in transitions:
+        current_state = _weighted_choice(*starting_states)
 
-        next_words_map = transitions[current_state]
-        words, counts = zip(*next_words_map.items())
+    message = [current_state if markov_order == 1 else current_state[1]]
 
-        if len(message) > soft_length_limit and "<END>" in next_words_map:
-            new_counts = list(counts)
-            end_index = words.index("<END>")
+    rand = random.random
+    bisect = bisect_right
+    get_next_words = transitions.get
+    append = message.append
+    order_one = markov_order == 1
+    hard_length_limit = max_length * 1.5
+    next_words = get_next_words(current_state)
 
-            length_penalty = (len(message) - soft_length_limit) / \
-                (max_length - soft_length_limit)
-            boost_factor = 1 + 4 * length_penalty
-            new_counts[end_index] = int(new_counts[end_index] * boost_factor)
+    while next_words and len(message) < hard_length_limit:
+        words, cum_weights = next_words
 
+        if len(message) > soft_length_limit and words[0] is _END:
             if len(message) > max_length:
-                next_word = "<END>"
+                next_word = _END
             else:
-                next_word = random.choices(
-                    words, weights=new_counts, k=1)[0]
+                end_weight = cum_weights[0]
+
+                length_penalty = (len(message) - soft_length_limit) / \
+                    (max_length - soft_length_limit)
+                boost_factor = 1 + 4 * length_penalty
+                extra_weight = int(end_weight * boost_factor) - end_weight
+
+                r = rand() * (cum_weights[-1] + extra_weight)
+                if r < end_weight + extra_weight:
+                    next_word = _END
+                else:
+                    next_word = words[bisect(cum_weights, r - extra_weight)]
         else:
-            next_word = random.choices(words, weights=counts, k=1)[0]
+            next_word = words[bisect(cum_weights, rand() * cum_weights[-1])]
 
-        if next_word == "<END>":
+        if next_word is _END:
             break
 
-        message.append(next_word)
+        append(next_word)
 
-        if markov_order == 1:
+        if order_one:
             current_state = next_word
         else:
             current_state = (current_state[1], next_word)
+        next_words = get_next_words(current_state)
 
     if not message:
         return "I tried, but I couldn't think of anything to say... It's not like I wanted to talk to you anyway!"
 
-    return " ".join(word for word in message if word not in ["<START>", "<END>"])
+    return " ".join(message)
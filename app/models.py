@@ -27,6 +27,8 @@ class MarkovData(Base):
     word1: Mapped[str] = mapped_column(String, primary_key=True)
     word2: Mapped[str] = mapped_column(String, primary_key=True)
     next_word: Mapped[str] = mapped_column(String, primary_key=True)
+    count: Mapped[int] = mapped_column(
+        Integer, nullable=False, default=1, server_default="1")
 
     created_at: Mapped[datetime] = mapped_column(
         DateTime, server_default=func.now())
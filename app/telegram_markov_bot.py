@@ -1,7 +1,13 @@
+import asyncio
 import logging
 import random
 import os
-import string
+import re
+import json
+import tempfile
+import time
+import ijson
+from collections import Counter
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, BotCommand
@@ -13,7 +19,6 @@ import database as database
 import markov as markov
 import crud as crud
 from database import SessionLocal
-import json
 
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -28,19 +33,49 @@ logging.Formatter.converter = lambda *args: datetime.now(
 logger = logging.getLogger(__name__)
 
 
+def _bot_name_words(names):
+    return frozenset(word for name in names for word in markov.tokenize(name))
+
+
+def _compile_mention_re(names):
+    return re.compile(
+        r"\b(?:" + "|".join(map(re.escape, names)) + r")\b", re.IGNORECASE)
+
+
+_BOT_NAMES = _bot_name_words(config.BOT_NAMES)
+_MENTION_RE = _compile_mention_re(config.BOT_NAMES)
+_ADMIN_CACHE: dict[int, tuple[frozenset[int], float]] = {}
+_FLUSH_REQUESTED = asyncio.Event()
+_WRITE_BEHIND_TASK: asyncio.Task | None = None
+
+
+async def get_chat_admin_ids(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> frozenset[int]:
+    now = time.monotonic()
+    cached = _ADMIN_CACHE.get(chat_id)
+    if cached and now - cached[1] < config.ADMIN_CACHE_TTL:
+        return cached[0]
+
+    admins = await context.bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(admin.user.id for admin in admins)
+    _ADMIN_CACHE.pop(chat_id, None)
+    _ADMIN_CACHE[chat_id] = (admin_ids, now)
+    if len(_ADMIN_CACHE) > config.ADMIN_CACHE_SIZE:
+        _ADMIN_CACHE.pop(next(iter(_ADMIN_CACHE)), None)
+    return admin_ids
+
+
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     if update.message.chat.type == 'private':
         return True
-    admins = await context.bot.get_chat_administrators(update.message.chat_id)
-    return update.message.from_user.id in [admin.user.id for admin in admins]
+    admin_ids = await get_chat_admin_ids(context, update.message.chat_id)
+    return update.message.from_user.id in admin_ids
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("H-hello... I'm a Markov Chain Bot. I guess you can add me to a group, or whatever. It's not like I want you to. Baka!")
 
 
-def get_starting_word_from_message(db, words, chat_id, force_use_word=False):
-    word_from_user_chance = crud.get_word_from_user_chance(db, chat_id)
+def get_starting_word_from_message(db, words, chat_id, word_from_user_chance, force_use_word=False):
     if not force_use_word and random.random() > word_from_user_chance:
         return None
 
@@ -48,13 +83,36 @@ def get_starting_word_from_message(db, words, chat_id, force_use_word=False):
     if not filtered_words:
         return None
 
-    random.shuffle(filtered_words)
+    startable_words = markov.filter_startable_words(db, chat_id, filtered_words)
+    candidates = [w for w in filtered_words if w in startable_words]
+    if not candidates:
+        return None
+
+    return random.choice(candidates)
+
 
-    for word in filtered_words:
-        if markov.word_exists_in_db(db, chat_id, word):
-            return word
+def respond_to_message(chat_id, words, is_private_chat, is_mention, is_reply):
+    with SessionLocal() as db:
+        should_respond = False
+
+        if is_mention or is_reply:
+            words = [word for word in words if word not in _BOT_NAMES]
+
+        settings = crud.get_chat_settings(db, chat_id)
+        if is_private_chat or is_mention or is_reply or (random.random() < settings.random_reply_chance):
+            should_respond = True
+            if not (is_private_chat or is_mention or is_reply):
+                logger.info("Randomly decided to reply in chat %s", chat_id)
 
-    return None
+        if not should_respond:
+            return None
+
+        markov.flush_pending_saves(db, chat_id)
+        force_use_word = not (is_mention or is_reply)
+        valid_start_word = get_starting_word_from_message(
+            db, words, chat_id, settings.word_from_user_chance, force_use_word=force_use_word)
+
+        return markov.generate_message(db, chat_id, starting_word=valid_start_word)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -63,74 +121,46 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return
 
-    words = [word.strip(string.punctuation).lower()
-             for word in text.split() if word.strip(string.punctuation)]
-    logger.info(f"Received message in chat {chat_id}: {text}")
-
-    db = SessionLocal()
-    try:
-        if len(words) >= 1:
-            word_sequence = ["<START>"] + words + ["<END>"]
-            word_pairs = [(word_sequence[i], word_sequence[i + 1], word_sequence[i + 2])
-                          for i in range(len(word_sequence) - 2)]
-            markov.save_to_database(db, chat_id, word_pairs)
+    words = markov.tokenize(text)
+    logger.info("Received message in chat %s: %s", chat_id, text)
 
-        should_respond = False
-        is_private_chat = update.message.chat.type == "private"
-        bot_names = ["marky", "марки"]
-        is_mention = any(keyword in text.lower() for keyword in bot_names)
-        is_reply = update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id
+    is_private_chat = update.message.chat.type == "private"
+    is_mention = _MENTION_RE.search(text) is not None
+    is_reply = update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id
 
-        if is_mention or is_reply:
-            words = [word for word in words if word not in bot_names]
+    if len(words) >= 1:
+        pending = markov.queue_for_save(chat_id, markov.word_triples(words))
+        if pending >= config.WRITE_BEHIND_MAX_ROWS:
+            _FLUSH_REQUESTED.set()
 
-        random_reply_chance = crud.get_random_reply_chance(db, chat_id)
-        if is_private_chat or is_mention or is_reply or (random.random() < random_reply_chance):
-            should_respond = True
-            if not (is_private_chat or is_mention or is_reply):
-                logger.info(f"Randomly decided to reply in chat {chat_id}")
+    message = await asyncio.to_thread(
+        respond_to_message, chat_id, words, is_private_chat, is_mention, is_reply)
+    if message:
+        await update.message.reply_text(message)
 
-        if should_respond:
-            force_use_word = not (is_mention or is_reply)
-            valid_start_word = get_starting_word_from_message(
-                db, words, chat_id, force_use_word=force_use_word)
 
-            message = markov.generate_message(
-                db, chat_id, starting_word=valid_start_word)
-            await update.message.reply_text(message)
-    finally:
-        db.close()
+def flush_and_generate(chat_id):
+    with SessionLocal() as db:
+        markov.flush_pending_saves(db, chat_id)
+        return markov.generate_message(db, chat_id)
 
 
 async def request_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    db = SessionLocal()
-    try:
-        message = markov.generate_message(db, chat_id)
-        await update.message.reply_text(message)
-    finally:
-        db.close()
+    message = await asyncio.to_thread(flush_and_generate, chat_id)
+    await update.message.reply_text(message)
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    db = SessionLocal()
-    try:
-        settings = crud.get_group_settings(db, chat_id)
-        if not settings:
-            settings = crud.update_group_settings(db, chat_id, {})
-
-        markov_order = settings.markov_order if settings.markov_order is not None else config.MARKOV_ORDER
-        random_reply_chance = settings.random_reply_chance if settings.random_reply_chance is not None else config.RANDOM_REPLY_CHANCE
-        word_from_user_chance = settings.word_from_user_chance if settings.word_from_user_chance is not None else config.WORD_FROM_USER_CHANCE
+    with SessionLocal() as db:
+        settings = crud.get_chat_settings(db, chat_id)
 
         message = "<b>My Boring Rules for This Chat</b>\n"
-        message += f"MARKOV_ORDER: {markov_order} (Whatever that means)\n"
-        message += f"RANDOM_REPLY_CHANCE: {random_reply_chance} (Don't expect too much)\n"
-        message += f"WORD_FROM_USER_CHANCE: {word_from_user_chance} (If I feel like it)\n"
+        message += f"MARKOV_ORDER: {settings.markov_order} (Whatever that means)\n"
+        message += f"RANDOM_REPLY_CHANCE: {settings.random_reply_chance} (Don't expect too much)\n"
+        message += f"WORD_FROM_USER_CHANCE: {settings.word_from_user_chance} (If I feel like it)\n"
         await update.message.reply_text(message, parse_mode=ParseMode.HTML)
-    finally:
-        db.close()
 
 
 async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -146,8 +176,7 @@ async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = context.args[1]
     chat_id = update.message.chat_id
 
-    db = SessionLocal()
-    try:
+    with SessionLocal() as db:
         if setting_name == "MARKOV_ORDER":
             try:
                 value = int(value)
@@ -180,12 +209,57 @@ async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("WORD_FROM_USER_CHANCE must be between 0 and 1.")
         else:
             await update.message.reply_text(f"Unknown setting: {setting_name}")
-    finally:
-        db.close()
 
-import json
-import ijson
-import tempfile
+
+def learn_from_texts(chat_id, texts):
+    total_words_learned = 0
+    lines_processed = 0
+    pair_counts = Counter()
+    batch_size = config.FEED_BATCH_SIZE
+
+    with SessionLocal() as db:
+        for text in texts:
+            words = markov.tokenize(text)
+            if len(words) >= 1:
+                pair_counts.update(markov.word_triples(words))
+                total_words_learned += len(words)
+                lines_processed += 1
+
+                if len(pair_counts) >= batch_size:
+                    markov.save_to_database(db, chat_id, pair_counts)
+                    pair_counts.clear()
+
+        if pair_counts:
+            markov.save_to_database(db, chat_id, pair_counts)
+
+    return total_words_learned, lines_processed
+
+
+def _export_message_texts(messages):
+    for message in messages:
+        text = message.get('text')
+        if message.get('type') == 'message' and isinstance(text, str) and text:
+            yield text
+
+
+def learn_from_json_file(chat_id, path, file_size):
+    with open(path, 'rb') as f:
+        if file_size <= config.JSON_STREAM_THRESHOLD_MB * 1024 * 1024:
+            logger.info("Processing as JSON file.")
+            data = json.load(f)
+            messages = data.get('messages', []) if isinstance(data, dict) else []
+        else:
+            logger.info(f"Processing as JSON file with the {ijson.backend} ijson backend.")
+            messages = ijson.items(f, 'messages.item', use_float=True)
+
+        return learn_from_texts(chat_id, _export_message_texts(messages))
+
+
+def learn_from_text_file(chat_id, path):
+    logger.info("Processing as plain text file.")
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        return learn_from_texts(chat_id, f)
+
 
 async def feed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
@@ -212,13 +286,7 @@ async def feed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     file = await context.bot.get_file(document.file_id)
-    
     chat_id = update.message.chat_id
-    db = SessionLocal()
-    total_words_learned = 0
-    lines_processed = 0
-    word_pairs_batch = []
-    batch_size = 1000
 
     with tempfile.NamedTemporaryFile(delete=False) as temp_file:
         await file.download_to_drive(custom_path=temp_file.name)
@@ -226,64 +294,31 @@ async def feed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         if is_json:
-            logger.info("Processing as JSON file.")
             try:
-                with open(temp_file_path, 'rb') as f:
-                    messages = ijson.items(f, 'messages.item')
-                    for message in messages:
-                        text = message.get('text')
-                        if message.get('type') == 'message' and isinstance(text, str) and text:
-                            words = [word.strip(string.punctuation).lower() for word in text.split() if word.strip(string.punctuation)]
-                            if len(words) >= 1:
-                                word_sequence = ["<START>"] + words + ["<END>"]
-                                word_pairs_batch.extend([(word_sequence[i], word_sequence[i+1], word_sequence[i+2]) for i in range(len(word_sequence) - 2)])
-                                total_words_learned += len(words)
-                                lines_processed += 1
-
-                                if len(word_pairs_batch) >= batch_size:
-                                    markov.save_to_database(db, chat_id, word_pairs_batch)
-                                    word_pairs_batch.clear()
-                
-                if word_pairs_batch:
-                    markov.save_to_database(db, chat_id, word_pairs_batch)
-
-                if lines_processed > 0:
-                    logger.info(f"Learned {total_words_learned} words from {lines_processed} messages in JSON file.")
-                    await update.message.reply_text(f"Nom nom... I guess that chat history was okay. I learned {total_words_learned} words from {lines_processed} messages. Don't get used to it.")
-                else:
-                    logger.info("No valid messages found in JSON file.")
-                    await update.message.reply_text("Hmph. That JSON file didn't have any messages I could learn from.")
-                return
-            except (ijson.JSONError, UnicodeDecodeError) as e:
+                total_words_learned, lines_processed = await asyncio.to_thread(
+                    learn_from_json_file, chat_id, temp_file_path, document.file_size)
+            except (ijson.JSONError, json.JSONDecodeError, UnicodeDecodeError) as e:
                 logger.error(f"Error processing JSON file: {e}", exc_info=True)
                 await update.message.reply_text("Hmph. That doesn't look like a proper Telegram export file. I'm not eating it.")
                 return
-        
-        # Processing for plain text files
-        logger.info("Processing as plain text file.")
-        with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
 
-        if not lines:
+            if lines_processed > 0:
+                logger.info(f"Learned {total_words_learned} words from {lines_processed} messages in JSON file.")
+                await update.message.reply_text(f"Nom nom... I guess that chat history was okay. I learned {total_words_learned} words from {lines_processed} messages. Don't get used to it.")
+            else:
+                logger.info("No valid messages found in JSON file.")
+                await update.message.reply_text("Hmph. That JSON file didn't have any messages I could learn from.")
+            return
+
+        # Processing for plain text files
+        if not os.path.getsize(temp_file_path):
             logger.info("Text file is empty.")
             await update.message.reply_text("This file is empty. Are you trying to starve me?")
             return
 
-        for line in lines:
-            words = [word.strip(string.punctuation).lower() for word in line.split() if word.strip(string.punctuation)]
-            if len(words) >= 1:
-                word_sequence = ["<START>"] + words + ["<END>"]
-                word_pairs_batch.extend([(word_sequence[i], word_sequence[i+1], word_sequence[i+2]) for i in range(len(word_sequence) - 2)])
-                total_words_learned += len(words)
-                lines_processed += 1
-
-                if len(word_pairs_batch) >= batch_size:
-                    markov.save_to_database(db, chat_id, word_pairs_batch)
-                    word_pairs_batch.clear()
+        total_words_learned, lines_processed = await asyncio.to_thread(
+            learn_from_text_file, chat_id, temp_file_path)
 
-        if word_pairs_batch:
-            markov.save_to_database(db, chat_id, word_pairs_batch)
-        
         logger.info(f"Learned {total_words_learned} words from {lines_processed} lines in text file.")
         await update.message.reply_text(f"Nom nom... Thanks for the meal, I guess. I learned {total_words_learned} words from {lines_processed} lines. Don't expect me to be grateful or anything!")
 
@@ -291,10 +326,27 @@ async def feed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"An unexpected error occurred during file processing: {e}", exc_info=True)
         await update.message.reply_text("Something went wrong while I was eating... I-it's not my fault, baka!")
     finally:
-        db.close()
         os.remove(temp_file_path)
 
 
+def flush_all_pending_saves():
+    with SessionLocal() as db:
+        markov.flush_pending_saves(db)
+
+
+async def write_behind_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_FLUSH_REQUESTED.wait(), config.WRITE_BEHIND_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _FLUSH_REQUESTED.clear()
+        try:
+            await asyncio.to_thread(flush_all_pending_saves)
+        except Exception as e:
+            logger.error(f"Error flushing pending saves: {e}", exc_info=True)
+
+
 async def set_bot_commands(application):
     commands = [
         BotCommand("start", "Start the bot."),
@@ -306,6 +358,28 @@ async def set_bot_commands(application):
     await application.bot.set_my_commands(commands)
 
 
+async def post_init(application):
+    global _WRITE_BEHIND_TASK, _BOT_NAMES, _MENTION_RE
+    await set_bot_commands(application)
+
+    if application.bot.username:
+        bot_names = [*config.BOT_NAMES, application.bot.username]
+        _BOT_NAMES = _bot_name_words(bot_names)
+        _MENTION_RE = _compile_mention_re(bot_names)
+
+    _WRITE_BEHIND_TASK = asyncio.create_task(write_behind_loop())
+
+
+async def post_shutdown(application):
+    if _WRITE_BEHIND_TASK:
+        _WRITE_BEHIND_TASK.cancel()
+        try:
+            await _WRITE_BEHIND_TASK
+        except asyncio.CancelledError:
+            pass
+    await asyncio.to_thread(flush_all_pending_saves)
+
+
 def main():
     if not TELEGRAM_BOT_TOKEN:
         logger.critical(
@@ -315,7 +389,15 @@ def main():
     logger.info("Setting up database...")
     database.setup_database()
 
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(config.CONCURRENT_UPDATES)
+        .connection_pool_size(config.CONNECTION_POOL_SIZE)
+        .pool_timeout(config.POOL_TIMEOUT)
+        .get_updates_pool_timeout(config.POOL_TIMEOUT)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("request", request_message))
@@ -325,7 +407,8 @@ def main():
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, handle_message))
 
-    application.post_init = set_bot_commands
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
     logger.info("Bot has started polling for updates.")
     application.run_polling()